@@ -12,6 +12,13 @@ class WrongZoneError(Exception):
         super().__init__(f"Identifier: ${identifier} are from different zone then others.")
 
 
+class UnknownZoneError(Exception):
+    def __init__(self, identifier, message="Unknown zone"):
+        self.identifier = identifier
+        self.message = message
+        super().__init__(f"Identifier: {identifier} has a TERYT code that doesn't belong to any PUWG 2000 zone.")
+
+
 class ServerConnectionError(Exception):
     def __init__(self, message="Connection error"):
         self.message = message
@@ -1,17 +1,17 @@
 # Copyright © 2024 Michal Chmielewski
+import functools
+import itertools
 import os
-from binascii import unhexlify
-from concurrent.futures import ThreadPoolExecutor
+import struct
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import ezdxf
-import requests
-from PyQt5.QtCore import pyqtSignal, QObject
-from pyproj import Transformer
-from requests.exceptions import ConnectionError, RequestException
-from shapely.ops import transform
-from shapely.wkb import loads
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject
 
-from errors import WrongZoneError, PathNotFoundError, ServerConnectionError
+from errors import WrongZoneError, PathNotFoundError, ServerConnectionError, UnknownZoneError
+from rate_limiter import TokenBucket
+
+# ezdxf, numpy, pyproj and requests are imported where they are used, so importing this module
+# (and showing the GUI) doesn't pay for loading them before the first run
 
 zone_5_teryts = ['3263', '3207', '3205', '3208', '3209', '3261', '3211', '3204', '3218', '3216', '3201', '3262',
                  '3214', '3203', '3206', '3212', '3202', '3217', '3210', '0806', '3002', '0801', '0861', '0805',
@@ -48,29 +48,113 @@ zone_8_teryts = ['2012', '2063', '2009', '2001', '2008', '2011', '2002', '2061',
                  '0617', '0606', '0602', '0620', '0664', '0604', '0618', '1809', '1814', '1804', '1813', '1862',
                  '1801']
 
+# Map each 4-digit TERYT prefix (voivodeship + county) straight to its PUWG 2000 zone
+_TERYT_ZONE = {**{teryt: 'EPSG:2176' for teryt in zone_5_teryts},
+               **{teryt: 'EPSG:2177' for teryt in zone_6_teryts},
+               **{teryt: 'EPSG:2178' for teryt in zone_7_teryts},
+               **{teryt: 'EPSG:2179' for teryt in zone_8_teryts}}
+del zone_5_teryts, zone_6_teryts, zone_7_teryts, zone_8_teryts
+
+ULDK_REQUESTS_PER_SECOND = 20
+ULDK_MAX_RETRIES = 5
+ULDK_MAX_PAUSE = 30  # seconds, upper bound for backoff and server-requested pauses
+ULDK_MAX_WORKERS = 16
+ULDK_TIMEOUT = (3.05, 15)  # (connect, read) seconds
+ULDK_ERROR_MESSAGE = 'błędny format odpowiedzi XML, usługa zwróciła odpowiedź'.encode('utf-8')
+DXF_WRITE_BUFFER_SIZE = 1 << 16
+STOP_POLL_INTERVAL = 0.2  # seconds between Stop checks while no fetch has finished
+WKB_POLYGON = 3
+EWKB_Z_FLAG = 0x80000000
+EWKB_M_FLAG = 0x40000000
+EWKB_SRID_FLAG = 0x20000000
+
+
+# Building a Transformer is expensive (PROJ pipeline setup), so reuse one per CRS pair
+@functools.lru_cache(maxsize=16)
+def _cached_transformer(source_crs, target_crs):
+    from pyproj import Transformer
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+# Area centroid of a closed ring (shoelace formula), avoids a GEOS round-trip per parcel
+def _ring_centroid(ring):
+    import numpy as np
+    coords = np.asarray(ring, dtype=np.float64)
+    # Work relative to the first vertex, at PUWG magnitudes the cross products would otherwise cancel out
+    origin = coords[0]
+    coords = coords - origin
+    x, y = coords[:, 0], coords[:, 1]
+    x1, y1 = np.roll(x, -1), np.roll(y, -1)
+    cross = x * y1 - x1 * y
+    area = 0.5 * cross.sum()
+    if area == 0:
+        return x.mean() + origin[0], y.mean() + origin[1]
+    return ((x + x1) * cross).sum() / (6 * area) + origin[0], ((y + y1) * cross).sum() / (6 * area) + origin[1]
+
+
+# Exterior ring of a (E)WKB polygon as an (n, 2) array, read straight from the buffer without building a geometry.
+# ULDK sends EWKB with an SRID, plain and ISO WKB (Z/M as 1000s in the type) are read too.
+def _decode_wkb_polygon(buffer):
+    import numpy as np
+    byte_order = '<' if buffer[0] == 1 else '>'
+    geometry_type, = struct.unpack_from(byte_order + 'I', buffer, 1)
+    offset = 5
+    if geometry_type & EWKB_SRID_FLAG:
+        offset += 4
+    dimensions = 2 + bool(geometry_type & EWKB_Z_FLAG) + bool(geometry_type & EWKB_M_FLAG)
+    geometry_type &= 0x0FFFFFFF
+    dimensions += (geometry_type // 1000 in (1, 2)) + 2 * (geometry_type // 1000 == 3)
+    if geometry_type % 1000 != WKB_POLYGON:
+        raise ValueError(f"expected a polygon, got WKB geometry type {geometry_type}")
+
+    ring_count, point_count = struct.unpack_from(byte_order + 'II', buffer, offset)
+    if ring_count == 0:
+        raise ValueError("empty polygon")
+    coords = np.frombuffer(buffer, dtype=byte_order + 'f8', count=point_count * dimensions, offset=offset + 8)
+    return coords.reshape(point_count, dimensions)[:, :2].astype(np.float64)
+
 
 class ParcelDrawer(QObject):
     progress_updated = pyqtSignal(int)
-    error_occurred = pyqtSignal(str)
+    finished = pyqtSignal()
+    failed = pyqtSignal(object)
 
     def __init__(self, identifiers, full_path, draw_as_lines=False, line_color=1, polygon_color=2,
                  identifier_color=3, add_identifier_at_layer=False, identifier_height=2.5,
-                 make_transformation_to_puwg_2000=False):
+                 make_transformation_to_puwg_2000=False, lines_as_polyline=False, binary_dxf=False,
+                 max_workers=None):
         super().__init__()
-        self.identifiers = identifiers
+        # Drop repeated identifiers (order kept), they would be fetched and drawn twice
+        self.identifiers = list(dict.fromkeys(identifiers))
         self.full_path = full_path
         self.draw_as_lines_flag = draw_as_lines  # Renamed attribute
+        self.lines_as_polyline = lines_as_polyline
         self.line_color = line_color
         self.polygon_color = polygon_color
         self.identifier_color = identifier_color
         self.add_identifier_at_layer = add_identifier_at_layer
         self.stop_requested = False
         self.failed_identifiers = []
+        self.error_messages = []
         self.make_transformation_to_puwg_2000 = make_transformation_to_puwg_2000
         self.identifier_height = identifier_height
+        self.binary_dxf = binary_dxf
+        # ezdxf copies dxfattribs on every add_*, so one dict per layer can be shared by all parcels
+        self.polygon_dxfattribs = {'layer': 'plot_as_polygon', 'color': polygon_color}
+        self.line_dxfattribs = {'layer': 'plot_as_lines', 'color': line_color}
+        self.identifier_dxfattribs = {'layer': 'identifier_layer', 'height': identifier_height,
+                                      'color': identifier_color}
+        # Drawing mode and labelling are fixed for the whole run, so the methods are picked once here
+        self.draw_parcel = self.draw_lines if draw_as_lines else self.draw_as_polygon
+        self.label_parcel = self.add_parcel_label if add_identifier_at_layer else self._skip_label
         self.set_zone = None
         self.doc = None
         self.msp = None
+        self.rate_limiter = TokenBucket(rate=ULDK_REQUESTS_PER_SECOND, burst=ULDK_REQUESTS_PER_SECOND,
+                                        max_pause=ULDK_MAX_PAUSE)
+        # Fetching is pure network latency, so use more threads than cores, capped to stay polite to ULDK
+        self.max_workers = max_workers or min(ULDK_MAX_WORKERS, max(4, (os.cpu_count() or 4) * 4))
+        self.session = self.create_session(self.max_workers)
 
     def save_log_error(self):
         if self.failed_identifiers:
@@ -79,123 +163,205 @@ class ParcelDrawer(QObject):
 
     def request_stop(self):
         self.stop_requested = True
+        # Wakes fetches waiting for a token or sitting out a rate-limit pause
+        self.rate_limiter.stop()
+
+    @pyqtSlot()
+    def run(self):
+        # Entry point when the drawer is moved to a worker QThread, results are handed back through signals
+        try:
+            self.read_or_create_dxf()
+            self.process_parcels()
+        except Exception as e:
+            self.failed.emit(e)
+        else:
+            self.finished.emit()
+
+    @staticmethod
+    def create_session(pool_size):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # One keep-alive pool shared by all fetch workers, 429 is left to the rate limiter
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        return session
 
     def fetch_wkb_data(self, identifier):
+        from binascii import unhexlify
+
+        from requests.exceptions import ConnectionError, RequestException
+
         url = f"https://uldk.gugik.gov.pl/?request=GetParcelById&id={identifier}"
         try:
-            response = requests.get(url)
+            for attempt in range(ULDK_MAX_RETRIES + 1):
+                if not self.rate_limiter.acquire():
+                    raise ValueError(f"Identifier: {identifier} was not fetched, processing was stopped.")
+                response = self.session.get(url, timeout=ULDK_TIMEOUT)
+                paused = self.rate_limiter.update_from_headers(response.headers)
+                if response.status_code != 429 or attempt == ULDK_MAX_RETRIES:
+                    break
+                # Back off on our own whenever the server gave no usable hint
+                if not paused:
+                    self.rate_limiter.pause(min(0.5 * 2 ** attempt, ULDK_MAX_PAUSE))
             response.raise_for_status()
-            hex_wkb_data = response.text.split('\n')[1]
+            # Work on the raw body: the first line is the status (0 or -1), the second the hex WKB in plain ASCII
+            lines = response.content.split(b'\n', 2)
+            status = lines[0].strip()
+            hex_wkb_data = lines[1].strip() if len(lines) > 1 else b''
         except ConnectionError as e:  # Catch connection-related errors
             raise ServerConnectionError("Connection error") from e
         except RequestException as e:  # Catch other requests-related errors
             raise ServerConnectionError("An error occurred while handling your request.") from e
 
-        if 'błędny format odpowiedzi XML, usługa zwróciła odpowiedź' in hex_wkb_data:
-            self.failed_identifiers.append(identifier)
+        if status.startswith(b'-1') or not hex_wkb_data or ULDK_ERROR_MESSAGE in hex_wkb_data:
             raise ValueError(f"Identifier: {identifier} does not exist or there was an error in the response.")
 
-        wkb_data = unhexlify(hex_wkb_data)
-        return loads(wkb_data), identifier
+        try:
+            coords = _decode_wkb_polygon(unhexlify(hex_wkb_data))
+        except (ValueError, struct.error) as e:
+            raise ValueError(f"Identifier: {identifier} returned a geometry that can't be read ({e}).") from e
+        return coords, identifier
 
     def read_or_create_dxf(self):
-        try:
+        import ezdxf
+
+        if os.path.isfile(self.full_path):
             self.doc = ezdxf.readfile(self.full_path)
-        except IOError:
+        else:
             self.doc = ezdxf.new('R2010')
         self.msp = self.doc.modelspace()
+        self._prepare_layers()
 
     def ensure_layer(self, layer_name, color=7):
         if not self.doc.layers.has_entry(layer_name):
             self.doc.layers.new(name=layer_name, dxfattribs={'color': color})
 
-    def draw_as_polygon(self, geometry, identifier):
-        layer_name = 'plot_as_polygon'
-        self.ensure_layer(layer_name, self.polygon_color)
-        coords = list(geometry.exterior.coords)
-        self.msp.add_lwpolyline(coords, dxfattribs={'layer': layer_name, 'color': self.polygon_color})
-        if self.add_identifier_at_layer:
-            short_id = identifier.split(".")[-1]
-            self.add_identifier(geometry, short_id)
-
-    def draw_lines(self, geometry, identifier):
-        layer_name = 'plot_as_lines'
-        self.ensure_layer(layer_name, self.line_color)
-        coords = list(geometry.exterior.coords)
-        for i in range(len(coords) - 1):
-            start_point = coords[i]
-            end_point = coords[i + 1]
-            self.msp.add_line(start_point, end_point, dxfattribs={'layer': layer_name, 'color': self.line_color})
+    def _prepare_layers(self):
+        # Layers are created once per document here, so the per-parcel draw methods don't have to check
+        if self.draw_as_lines_flag:
+            self.ensure_layer(self.line_dxfattribs['layer'], self.line_color)
+        else:
+            self.ensure_layer(self.polygon_dxfattribs['layer'], self.polygon_color)
         if self.add_identifier_at_layer:
-            short_id = identifier.split(".")[-1]
-            self.add_identifier(geometry, short_id)
+            self.ensure_layer(self.identifier_dxfattribs['layer'], self.identifier_color)
 
-    def add_identifier(self, geometry, identifier):
-        identifier_layer = 'identifier_layer'
-        self.ensure_layer(identifier_layer, self.identifier_color)
-        centroid = geometry.centroid
-        self.msp.add_text(identifier, dxfattribs={'layer': identifier_layer, 'height': self.identifier_height,
-                                                  'insert': (centroid.x, centroid.y), 'color': self.identifier_color})
+    def draw_as_polygon(self, coords, identifier):
+        # Closed flag instead of repeating the first vertex, so CAD sees a real closed boundary
+        self.msp.add_lwpolyline(coords[:-1], close=True, dxfattribs=self.polygon_dxfattribs)
+        self.label_parcel(coords, identifier)
+
+    def draw_lines(self, coords, identifier):
+        dxfattribs = self.line_dxfattribs
+        if self.lines_as_polyline:
+            # One closed entity instead of one LINE per edge, the ring's repeated end point is dropped
+            self.msp.add_lwpolyline(coords[:-1], close=True, dxfattribs=dxfattribs)
+        else:
+            for start_point, end_point in zip(coords, coords[1:]):
+                self.msp.add_line(start_point, end_point, dxfattribs=dxfattribs)
+        self.label_parcel(coords, identifier)
+
+    def add_parcel_label(self, coords, identifier):
+        short_id = identifier.rpartition(".")[2]
+        self.add_identifier(coords, short_id)
+
+    @staticmethod
+    def _skip_label(coords, identifier):
+        pass
+
+    def add_identifier(self, coords, identifier):
+        centroid_x, centroid_y = _ring_centroid(coords)
+        self.msp.add_text(identifier, dxfattribs={**self.identifier_dxfattribs, 'insert': (centroid_x, centroid_y)})
 
     def process_parcels(self):
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(self.fetch_wkb_data, identifier) for identifier in self.identifiers]
-            for i, future in enumerate(futures):
-                if self.stop_requested:
-                    break
-                try:
-                    geometry, identifier = future.result()
-                    target_crs = self.determine_zone(identifier)
-                except ValueError as e:
-                    self.error_occurred.emit(str(e))
-                    continue
-                # Check if zone are same for each identifier
-                if self.set_zone:
-                    if target_crs == self.set_zone:
-                        if self.make_transformation_to_puwg_2000:
-                            geometry = self.transform_to_puwg_2000(geometry, target_crs)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # The zone only depends on the identifier, so mixed zones are rejected before anything is fetched
+            self.set_zone = self.resolve_zone(self.identifiers)
+            # Only a window of fetches is queued at a time and refilled as they finish, so memory stays bounded
+            # for large batches and Stop doesn't leave thousands of queued requests behind
+            pending_identifiers = iter(self.identifiers)
+            futures = {executor.submit(self.fetch_wkb_data, identifier): identifier
+                       for identifier in itertools.islice(pending_identifiers, self.max_workers * 2)}
+            # Consume in completion order so one slow response doesn't hold back drawing of the others.
+            # Drawing stays on this thread because ezdxf documents are not thread-safe.
+            completed = 0
+            last_progress = -1
+            while futures and not self.stop_requested:
+                # Short timeout so Stop is noticed even while every fetch in the window is still waiting on ULDK
+                done, _ = wait(futures, timeout=STOP_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    identifier = futures.pop(future)
+                    try:
+                        coords, identifier = future.result()
+                    except ValueError as e:
+                        # Collected and reported once after the loop instead of one signal per failed parcel
+                        self.failed_identifiers.append(identifier)
+                        self.error_messages.append(str(e))
                     else:
-                        raise WrongZoneError(identifier)
-                else:
-                    self.set_zone = target_crs
+                        # Outline and identifier label both work from the same ring array
+                        if self.make_transformation_to_puwg_2000:
+                            coords = self.transform_to_puwg_2000(coords, self.set_zone)
 
-                    if self.make_transformation_to_puwg_2000:
-                        geometry = self.transform_to_puwg_2000(geometry, target_crs)
+                        self.draw_parcel(coords, identifier)
 
-                if self.draw_as_lines_flag:
-                    self.draw_lines(geometry, identifier)
-                else:
-                    self.draw_as_polygon(geometry, identifier)
+                    # Failed parcels count as done too, and the bar only repaints when the percentage moves
+                    completed += 1
+                    progress = completed * 100 // len(self.identifiers)
+                    if progress > last_progress:
+                        self.progress_updated.emit(progress)
+                        last_progress = progress
 
-                progress = (i + 1) / len(self.identifiers) * 100
-                self.progress_updated.emit(progress)
+                if not self.stop_requested:
+                    for identifier in itertools.islice(pending_identifiers, len(done)):
+                        futures[executor.submit(self.fetch_wkb_data, identifier)] = identifier
+        finally:
+            # After Stop, queued fetches are dropped and running ones finish in the background, their results unused
+            executor.shutdown(wait=not self.stop_requested, cancel_futures=True)
+            self.session.close()
 
     def save_dxf(self):
         directory, filename = os.path.split(self.full_path)
+        # Same streams ezdxf's saveas opens, but with a larger buffer so big documents need fewer write calls
         try:
-            self.doc.saveas(self.full_path)
+            # Binary DXF is smaller and faster to write, but not every viewer reads it, so it's opt-in
+            if self.binary_dxf:
+                stream = open(self.full_path, 'wb', buffering=DXF_WRITE_BUFFER_SIZE)
+            else:
+                stream = open(self.full_path, 'wt', encoding=self.doc.output_encoding, errors='dxfreplace',
+                              buffering=DXF_WRITE_BUFFER_SIZE)
         except FileNotFoundError:
             raise PathNotFoundError(directory)
+        with stream:
+            self.doc.write(stream, fmt='bin' if self.binary_dxf else 'asc')
+
+    @classmethod
+    def resolve_zone(cls, identifiers):
+        # An unknown TERYT prefix has no zone to transform into and can't be checked against the others,
+        # so the whole batch is rejected instead of drawing that parcel in some other identifier's zone
+        zones = {}
+        for identifier in identifiers:
+            zones.setdefault(cls.determine_zone(identifier), identifier)
+        if None in zones:
+            raise UnknownZoneError(zones[None])
+        if len(zones) > 1:
+            raise WrongZoneError(list(zones.values())[1])
+        return next(iter(zones), None)
 
     @staticmethod
     def determine_zone(identifier):
-        starting_sequence = identifier[:4]
-        if starting_sequence in zone_5_teryts:
-            return 'EPSG:2176'
-        elif starting_sequence in zone_6_teryts:
-            return 'EPSG:2177'
-        elif starting_sequence in zone_7_teryts:
-            return 'EPSG:2178'
-        elif starting_sequence in zone_8_teryts:
-            return 'EPSG:2179'
+        return _TERYT_ZONE.get(identifier[:4])
 
     @staticmethod
-    def transform_to_puwg_2000(geometry, target_crs):
+    def transform_to_puwg_2000(coords, target_crs):
+        import numpy as np
+
         # Define source CRS
         source_crs = 'EPSG:2180'  # PUWG 1992
 
-        # Create a transformer object for the CRS transformation
-        transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-
-        # Perform the transformation and return
-        return transform(transformer.transform, geometry)
+        # Transform the whole ring in a single call instead of one Python callback per vertex
+        xs, ys = _cached_transformer(source_crs, target_crs).transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([xs, ys])
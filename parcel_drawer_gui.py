@@ -1,115 +1,188 @@
 # Copyright © 2024 Michal Chmielewski
+import functools
+import locale
 import os
-from ctypes import WinDLL
+import re
+import sys
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap, QColor, QIcon
-from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog,
+from PyQt5.QtCore import pyqtSignal, Qt, QObject, QRunnable, QSettings, QThread, QThreadPool
+from PyQt5.QtGui import QPixmap, QColor, QIcon, QStandardItem, QStandardItemModel
+from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QFileDialog,
                              QRadioButton, QHBoxLayout, QCheckBox, QMessageBox,
-                             QProgressBar, QSpacerItem, QSizePolicy, QComboBox, QDoubleSpinBox)
-
-from errors import WrongZoneError, PathNotFoundError, ServerConnectionError
-from parcel_drawer import ParcelDrawer
-
-
-# Helper function to get the keyboard layout
-def get_keyboard_layout():
-    user32 = WinDLL('user32', use_last_error=True)
-    hkl = user32.GetKeyboardLayout(0)
-    language_id = hkl & (2**16 - 1)
-    language_code = hex(language_id)
-    return language_code
-
-
-# Helper function to get the Windows display language
-def get_windows_display_language():
-    try:
-        import winreg
-        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Control Panel\\Desktop")
-        language, _ = winreg.QueryValueEx(key, "PreferredUILanguages")
-        winreg.CloseKey(key)
-        return language
-    except Exception as e:
-        print(f"Error reading registry: {e}")
-        return None
+                             QProgressBar, QSpacerItem, QSizePolicy, QComboBox, QDoubleSpinBox, QSpinBox)
+
+from errors import WrongZoneError, PathNotFoundError, ServerConnectionError, UnknownZoneError
+from parcel_drawer import ParcelDrawer, ULDK_MAX_WORKERS
+
+
+# AutoCAD Color Index for the names shown in the color combo boxes
+_COLOR_ACI = {
+    "Red": 1,
+    "Yellow": 2,
+    "Green": 3,
+    "Blue": 5,
+    "Black": 7,
+    "White": 7
+}
+
+
+# Message box and status texts per UI language, {} is filled in with str.format
+_MESSAGES = {
+    "en-US": {
+        "missing_input": "Please enter both identifiers and a file path.",
+        "path_not_found": "The path not found: {}",
+        "save_path_not_found": "The path not found: {}, please try again",
+        "server_error": "There is a connection issue to the server. Please try again later.",
+        "wrong_zone": "Your identifiers are from different zones.",
+        "unknown_zone": "The zone of identifier {} is unknown, check its TERYT code.",
+        "failed_identifiers": "{} identifier(s) could not be processed.",
+        "success": "Plot borders have been added",
+        "no_file": "No file selected",
+        "file_loading": "Loading...",
+        "file_loaded": "Identifiers loaded: {}",
+        "file_read_error": "The file could not be read: {}",
+    },
+    "pl-PL": {
+        "missing_input": "Proszę wprowadzić identyfikatory i ścieżkę do pliku.",
+        "path_not_found": "Podana ścieżka nie istnieje: {}",
+        "save_path_not_found": "Podana ścieżka nie istnieje: {}, spróbuj ponownie",
+        "server_error": "Problem z połączeniem do serwera. Spróbuj później.",
+        "wrong_zone": "Twoje identyfikatory nie pochodzą z jednej strefy.",
+        "unknown_zone": "Nieznana strefa identyfikatora {}, sprawdź jego kod TERYT.",
+        "failed_identifiers": "Nie udało się przetworzyć identyfikatorów: {}.",
+        "success": "Obramowania działek zostały dodane",
+        "no_file": "Nie wybrano pliku",
+        "file_loading": "Wczytywanie...",
+        "file_loaded": "Wczytano identyfikatorów: {}",
+        "file_read_error": "Nie udało się wczytać pliku: {}",
+    },
+}
+
+# Message keys for the errors a run can fail with, anything else is shown as is
+_FAILURE_MESSAGE_KEYS = {
+    ServerConnectionError: "server_error",
+    WrongZoneError: "wrong_zone",
+    UnknownZoneError: "unknown_zone",
+}
+
+# Default folder for the output file, "~" is expanded on its own so the path is also right outside Windows
+_DESKTOP = os.path.join(os.path.expanduser("~"), "Desktop")
+
+
+# Skip per-entry icon and symlink lookups, which make the dialogs very slow on network drives
+_FILE_DIALOG_OPTIONS = QFileDialog.DontUseCustomDirectoryIcons | QFileDialog.DontResolveSymlinks
+
+
+# Locale name prefixes (POSIX 'pl_PL', Windows 'Polish_Poland') and Windows LANGIDs that switch the UI to Polish
+_POLISH_LOCALES = ('pl', 'Polish')
+_POLISH_LANGIDS = frozenset({0x0415})
+
+
+# Helper function to get the Windows UI language as a LANGID (0x0415 is Polish)
+def get_windows_ui_language():
+    import ctypes
+    return ctypes.windll.kernel32.GetUserDefaultUILanguage() & 0xFFFF
+
+
+# Helper function to get the active keyboard layout's LANGID, a Polish layout also switches the UI to Polish
+def get_keyboard_layout_language():
+    import ctypes
+    return ctypes.windll.user32.GetKeyboardLayout(0) & 0xFFFF
+
+
+# The language can't change while the app runs, so it is detected once per process
+@functools.lru_cache(maxsize=1)
+def detect_language():
+    # The process locale is free to read and settles most cases without touching the Windows API
+    system_locale = locale.getlocale()[0] or ''
+    if system_locale.startswith(_POLISH_LOCALES):
+        return "pl-PL"
+    if sys.platform == 'win32' and (get_windows_ui_language() in _POLISH_LANGIDS
+                                    or get_keyboard_layout_language() in _POLISH_LANGIDS):
+        return "pl-PL"
+    return "en-US"
 
 
 class ColorComboBox(QComboBox):
+    # Both combo boxes list the same colors, so they share one model (and its icons) built on first use
+    _color_model = None
+
     def __init__(self, parent=None):
         super(ColorComboBox, self).__init__(parent)
-        self.populate_colors()
-
-    def populate_colors(self):
-        color_names = {
-            "Red": "#ff0000",
-            "Green": "#00ff00",
-            "Blue": "#0000ff",
-            "Yellow": "#ffff00",
-            "Black": "#000000",
-            "White": "#ffffff",
-        }
-        for name, hex in color_names.items():
-            # Create a pixmap and fill it with the color
-            pixmap = QPixmap(20, 20)
-            pixmap.fill(QColor(hex))
-            # Create an icon from the pixmap
-            icon = QIcon(pixmap)
-            # Add the item to the combo box with the icon and the color name
-            self.addItem(icon, name)
+        self.setModel(self.color_model())
+
+    @classmethod
+    def color_model(cls):
+        if cls._color_model is None:
+            color_names = {
+                "Red": "#ff0000",
+                "Green": "#00ff00",
+                "Blue": "#0000ff",
+                "Yellow": "#ffff00",
+                "Black": "#000000",
+                "White": "#ffffff",
+            }
+            # Owned by the application so it outlives every window that uses it
+            cls._color_model = QStandardItemModel(QApplication.instance())
+            for name, hex in color_names.items():
+                # Create a pixmap filled with the color and add it as the item's icon
+                pixmap = QPixmap(20, 20)
+                pixmap.fill(QColor(hex))
+                cls._color_model.appendRow(QStandardItem(QIcon(pixmap), name))
+        return cls._color_model
+
+
+class IdentifierFileSignals(QObject):
+    loaded = pyqtSignal(list)
+    failed = pyqtSignal(object)
+
+
+# Reads an identifier file on the global thread pool, a large file on a network share would otherwise freeze the window
+class IdentifierFileReader(QRunnable):
+    def __init__(self, file_path):
+        super().__init__()
+        self.file_path = file_path
+        # QRunnable isn't a QObject, so its results are sent through a separate signals object
+        self.signals = IdentifierFileSignals()
+
+    def run(self):
+        try:
+            identifiers = ParcelDrawerGUI.read_identifiers_from_file(self.file_path)
+        except (OSError, ValueError) as e:
+            self.signals.failed.emit(e)
+        else:
+            self.signals.loaded.emit(identifiers)
 
 
 class ParcelDrawerGUI(QWidget):
     def __init__(self):
         super().__init__()
+        self.drawer = None
+        self.worker_thread = None
+        self.identifier_list = None
+        self.identifier_reader = None
         self.initUI()
         self.stop_requested = False
-        self.ignore_all_errors = False
         # Check system locale and set messages
-        # Check the keyboard layout or Windows display language
-        try:
-            keyboard_layout = get_keyboard_layout()
-        except:
-            keyboard_layout = '0x409'
-        try:
-            windows_display_language = get_windows_display_language()[0]
-        except:
-            windows_display_language = 'en-US'
-        self.language = "en-US"
-        if keyboard_layout == '0x415' or windows_display_language.startswith('pl-PL'):
+        self.language = detect_language()
+        self.messages = _MESSAGES[self.language]
+        if self.language == "pl-PL":
             self.set_polish_language()
-            self.language = "pl-PL"
 
         # Set default file path to user's desktop
-        self.default_file_path = os.path.join(os.path.expanduser("~\\Desktop"), "parcelDrawer.dxf")
+        self.default_file_path = os.path.join(_DESKTOP, "parcelDrawer.dxf")
         self.filepath_display.setText(self.default_file_path)
 
-    def show_error_message(self, message):
-        if not self.ignore_all_errors:
-            info_text = "Do you want to continue or stop processing?"
-            continue_button = "Continue"
-            continue_all_button = "Continue for all"
-            if self.language == "pl-PL":
-                info_text = "Czy chcesz kontynuować czy przerwać przetwarzanie?"
-                continue_button = "Kontynuuj"
-                continue_all_button = "Kontynuuj dla wszystkich"
-
-            msgBox = QMessageBox()
-            msgBox.setIcon(QMessageBox.Warning)
-            msgBox.setWindowTitle("Warning")
-            msgBox.setText(message)
-            msgBox.setInformativeText(info_text)
-            continueButton = msgBox.addButton(continue_button, QMessageBox.AcceptRole)
-            continueAllButton = msgBox.addButton(continue_all_button, QMessageBox.YesRole)
-            stopButton = msgBox.addButton("Stop", QMessageBox.RejectRole)
-            msgBox.setDefaultButton(continueButton)
-            msgBox.exec_()
-
-            if msgBox.clickedButton() == stopButton:
-                self.drawer.request_stop()
-                self.stop_requested = True
-                self.update_progress_bar(0)
-            elif msgBox.clickedButton() == continueAllButton:
-                self.ignore_all_errors = True
+    def show_error_message(self, messages):
+        # Shown once the run is over with every failed identifier, Save keeps the parcels that succeeded
+        self.error_box.setText(self.messages["failed_identifiers"].format(len(messages)))
+        self.error_box.setDetailedText('\n'.join(messages))
+        self.error_box.exec_()
+
+        if self.error_box.clickedButton() == self.error_discard_button:
+            self.drawer.request_stop()
+            self.stop_requested = True
+            self.update_progress_bar(0)
 
     def set_polish_language(self):
         self.identifier_label_text = "Wpisz identyfikatory działek (oddzielone przecinkami)\n" \
@@ -126,6 +199,9 @@ class ParcelDrawerGUI(QWidget):
         self.puwg_transformation_checkbox_text = "Czy chcesz dokonać transformacji układu" \
                                                  " współrzędnych PUWG 1992 do PUWG 2000?"
         self.spin_box_label_text = "Wysokość tekstu dla Identyfikatorów"
+        self.max_workers_label_text = "Liczba równoległych zapytań do ULDK:"
+        self.lines_as_polyline_checkbox_text = "Połącz linie każdej działki w jedną polilinię"
+        self.binary_dxf_checkbox_text = "Zapisz jako binarny DXF (mniejszy, nie każdy program go obsługuje)"
 
         # Set the texts
         self.identifier_label.setText(self.identifier_label_text)
@@ -139,6 +215,12 @@ class ParcelDrawerGUI(QWidget):
         self.identifier_file_label.setText(self.identifier_file_label_text)
         self.puwg_transformation_checkbox.setText(self.puwg_transformation_checkbox_text)
         self.spin_box_label.setText(self.spin_box_label_text)
+        self.max_workers_label.setText(self.max_workers_label_text)
+        self.lines_as_polyline_checkbox.setText(self.lines_as_polyline_checkbox_text)
+        self.binary_dxf_checkbox.setText(self.binary_dxf_checkbox_text)
+        self.error_box.setInformativeText("Zapisać działki, które udało się przetworzyć?")
+        self.error_save_button.setText("Zapisz")
+        self.error_discard_button.setText("Odrzuć")
 
     def initUI(self):
         layout = QVBoxLayout()
@@ -150,6 +232,7 @@ class ParcelDrawerGUI(QWidget):
         # Identifier Input
         self.identifier_label = QLabel("Enter Parcel Identifiers (comma-separated):")
         self.identifier_input = QLineEdit(self)
+        self.identifier_input.textEdited.connect(self.on_identifier_input_edited)
         layout.addWidget(self.identifier_label)
         layout.addWidget(self.identifier_input)
 
@@ -177,6 +260,10 @@ class ParcelDrawerGUI(QWidget):
         layout.addWidget(self.filepath_display)
         layout.addWidget(self.filepath_button)
 
+        # Binary DXF is smaller and faster to save, but not every viewer opens it, so ASCII stays the default
+        self.binary_dxf_checkbox = QCheckBox("Save as binary DXF (smaller, not supported by every program)")
+        layout.addWidget(self.binary_dxf_checkbox)
+
         # Drawing Options
         self.drawing_option_label = QLabel("Choose Drawing Option:")
         self.polygon_radio = QRadioButton("Polygon")
@@ -188,10 +275,15 @@ class ParcelDrawerGUI(QWidget):
         layout.addWidget(self.drawing_option_label)
         layout.addLayout(radio_layout)
 
+        # Lines mode only: one closed polyline per parcel instead of a separate line per edge
+        self.lines_as_polyline_checkbox = QCheckBox("Join each parcel's lines into one polyline")
+        self.lines_as_polyline_checkbox.setEnabled(False)
+        self.lines_radio.toggled.connect(self.lines_as_polyline_checkbox.setEnabled)
+        layout.addWidget(self.lines_as_polyline_checkbox)
+
         # Color Selection
         self.color_label = QLabel("Select Drawing Layer Color:")
         self.color_combo = ColorComboBox(self)
-        self.color_combo.currentIndexChanged.connect(self.on_color_combo_changed)  # Connect the change event
         layout.addWidget(self.color_label)
         layout.addWidget(self.color_combo)
 
@@ -203,7 +295,6 @@ class ParcelDrawerGUI(QWidget):
         # Color Selection
         self.color_label_id = QLabel("Select Identifier Layer Color:")
         self.color_combo_id = ColorComboBox(self)
-        self.color_combo_id.currentIndexChanged.connect(self.on_color_combo_changed)  # Connect the change event
         layout.addWidget(self.color_label_id)
         layout.addWidget(self.color_combo_id)
         self.color_label_id.hide()  # Initially hide the label
@@ -220,10 +311,34 @@ class ParcelDrawerGUI(QWidget):
         layout.addWidget(self.spin_box)
         self.spin_box.hide()  # Initially hide the spin box
 
-        # OK Button
+        # Number of parallel ULDK requests, remembered between sessions
+        self.settings = QSettings("Michal Chmielewski", "Parcel Drawer")
+        self.max_workers_label = QLabel("Number of parallel ULDK requests:", self)
+        layout.addWidget(self.max_workers_label)
+        self.max_workers_spin_box = QSpinBox(self)
+        self.max_workers_spin_box.setRange(1, 2 * ULDK_MAX_WORKERS)
+        self.max_workers_spin_box.setValue(self.settings.value("max_workers", ULDK_MAX_WORKERS, type=int))
+        layout.addWidget(self.max_workers_spin_box)
+
+        # OK and Stop Buttons
         self.ok_button = QPushButton('Ok', self)
         self.ok_button.clicked.connect(self.on_click)
-        layout.addWidget(self.ok_button)
+        self.stop_button = QPushButton('Stop', self)
+        self.stop_button.clicked.connect(self.on_stop_click)
+        self.stop_button.setEnabled(False)
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(self.ok_button)
+        button_layout.addWidget(self.stop_button)
+        layout.addLayout(button_layout)
+
+        # Summary of failed identifiers, built once and refilled at the end of every run
+        self.error_box = QMessageBox(self)
+        self.error_box.setIcon(QMessageBox.Warning)
+        self.error_box.setWindowTitle("Warning")
+        self.error_box.setInformativeText("Save the parcels that succeeded?")
+        self.error_save_button = self.error_box.addButton("Save", QMessageBox.AcceptRole)
+        self.error_discard_button = self.error_box.addButton("Discard", QMessageBox.RejectRole)
+        self.error_box.setDefaultButton(self.error_save_button)
 
         # Copyright Label
         copyright_label = QLabel("Copyright © 2024 Michał Chmielewski")
@@ -254,9 +369,8 @@ class ParcelDrawerGUI(QWidget):
             self.spin_box.hide()
 
     def open_file_dialog(self):
-        options = QFileDialog.Options()
         file_path, _ = QFileDialog.getSaveFileName(self, "Select or Create File", self.default_file_path,
-                                                   "DXF Files (*.dxf)", options=options)
+                                                   "DXF Files (*.dxf)", options=_FILE_DIALOG_OPTIONS)
 
         if file_path:
             # Normalize file path for Windows
@@ -264,117 +378,166 @@ class ParcelDrawerGUI(QWidget):
             # Set the file path to the QLineEdit to display it
             self.filepath_display.setText(file_path)
 
-    def on_color_combo_changed(self):
-        # Remove duplicate entries if necessary
-        current_color = self.color_combo.currentText()
-        for i in range(self.color_combo.count()):
-            if self.color_combo.itemText(i) == current_color and i != self.color_combo.currentIndex():
-                self.color_combo.removeItem(i)
-                break  # Break after removing the duplicate to avoid skipping items
-
     def update_progress_bar(self, value):
         self.progress_bar.setValue(value)
 
     def upload_identifier_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Identifier File", "",
-                                                   "Text Files (*.txt);;All Files (*)")
+                                                   "Text Files (*.txt);;All Files (*)", options=_FILE_DIALOG_OPTIONS)
         if file_path:
             self.identifier_file_path = file_path
-            self.identifier_file_label.setText(file_path)
-            identifiers = self.read_identifiers_from_file(file_path)
-            self.identifier_input.setText(','.join(identifiers))
+            self.identifier_file_label.setText(f"{file_path}\n{self.messages['file_loading']}")
+            # No new file and no run until this one is read, so Ok can't start with the previous identifiers
+            self.identifier_file_button.setEnabled(False)
+            self.ok_button.setEnabled(False)
+            self.identifier_reader = IdentifierFileReader(file_path)
+            self.identifier_reader.signals.loaded.connect(self.on_identifier_file_loaded)
+            self.identifier_reader.signals.failed.connect(self.on_identifier_file_failed)
+            QThreadPool.globalInstance().start(self.identifier_reader)
+
+    def on_identifier_file_loaded(self, identifiers):
+        # Kept as a list instead of pasted into the line edit, which gets slow with thousands of identifiers
+        self.identifier_list = identifiers
+        self.identifier_input.clear()
+        loaded_text = self.messages["file_loaded"].format(len(identifiers))
+        self.identifier_file_label.setText(f"{self.identifier_file_path}\n{loaded_text}")
+        self.on_identifier_file_read()
+
+    def on_identifier_file_failed(self, error):
+        self.identifier_list = None
+        self.identifier_file_label.setText(self.messages["no_file"])
+        QMessageBox.critical(self, "Error", self.messages["file_read_error"].format(error))
+        self.on_identifier_file_read()
+
+    def on_identifier_file_read(self):
+        self.identifier_reader = None
+        self.identifier_file_button.setEnabled(True)
+        self.ok_button.setEnabled(self.worker_thread is None or not self.worker_thread.isRunning())
+
+    def on_identifier_input_edited(self):
+        # Typed identifiers replace the ones loaded from a file
+        if self.identifier_list is not None:
+            self.identifier_list = None
+            self.identifier_file_label.setText(self.messages["no_file"])
 
     def on_click(self):
         draw_as_lines = False
-        color_aci = {
-            "Red": 1,
-            "Yellow": 2,
-            "Green": 3,
-            "Blue": 5,
-            "Black": 7,
-            "White": 7
-        }
+        self.stop_requested = False
 
         identifiers = self.identifier_input.text().strip()
         file_path = self.filepath_display.text().strip()
 
         # Check for empty inputs
-        if not identifiers or not file_path:
-            if self.language == "pl-PL":
-                QMessageBox.warning(self, "Warning", "Proszę wprowadzić identyfikatory i ścieżkę do pliku.")
-            else:
-                QMessageBox.warning(self, "Warning", "Please enter both identifiers and a file path.")
+        if not (identifiers or self.identifier_list) or not file_path:
+            QMessageBox.warning(self, "Warning", self.messages["missing_input"])
             return
 
         directory, filename = os.path.split(file_path)
         if not os.path.isdir(directory):
-            if self.language == "pl-PL":
-                QMessageBox.critical(self, "Warning", f"Podana ścieżka nie istnieje: {directory}")
-            else:
-                QMessageBox.critical(self, "Warning", f"The path not found: {directory}")
+            QMessageBox.critical(self, "Warning", self.messages["path_not_found"].format(directory))
             return
 
         color = self.color_combo.currentText()
         color_id = self.color_combo_id.currentText()
         is_polygon = self.polygon_radio.isChecked()
         add_identifier = self.add_identifier_checkbox.isChecked()
-        list_of_identifiers = identifiers.split(',')
-        list_of_identifiers = list(filter(None, list_of_identifiers))
         puwg_transformation = self.puwg_transformation_checkbox.isChecked()
-        height_identifier_text = float(self.spin_box.cleanText())
+        lines_as_polyline = self.lines_as_polyline_checkbox.isChecked()
+        binary_dxf = self.binary_dxf_checkbox.isChecked()
+        # value() is already a float, parsing cleanText() breaks on locales with a decimal comma
+        height_identifier_text = self.spin_box.value()
+        max_workers = self.max_workers_spin_box.value()
+        if self.identifier_list:
+            list_of_identifiers = self.identifier_list
+        else:
+            # Padding around commas would otherwise reach ULDK and fail as an unknown identifier
+            list_of_identifiers = [identifier for identifier in map(str.strip, identifiers.split(',')) if identifier]
+        self.settings.setValue("max_workers", max_workers)
+
+        # Mixed or unknown zones are reported right away, before the worker thread starts and without any ULDK request
+        try:
+            ParcelDrawer.resolve_zone(list_of_identifiers)
+        except (WrongZoneError, UnknownZoneError) as e:
+            self.on_drawer_failed(e)
+            return
 
         if not is_polygon:
             draw_as_lines = True
         self.drawer = ParcelDrawer(list_of_identifiers, file_path, draw_as_lines=draw_as_lines,
-                                   line_color=color_aci[color], polygon_color=color_aci[color],
-                                   identifier_color=color_aci[color_id], add_identifier_at_layer=add_identifier,
+                                   line_color=_COLOR_ACI[color], polygon_color=_COLOR_ACI[color],
+                                   identifier_color=_COLOR_ACI[color_id], add_identifier_at_layer=add_identifier,
                                    identifier_height=height_identifier_text,
-                                   make_transformation_to_puwg_2000=puwg_transformation)
-        self.drawer.error_occurred.connect(self.show_error_message)
+                                   make_transformation_to_puwg_2000=puwg_transformation,
+                                   lines_as_polyline=lines_as_polyline, binary_dxf=binary_dxf,
+                                   max_workers=max_workers)
         self.drawer.progress_updated.connect(self.update_progress_bar)
 
-        self.drawer.read_or_create_dxf()
-        try:
-            self.drawer.process_parcels()
-        except ServerConnectionError:
-            if self.language == "pl-PL":
-                QMessageBox.critical(self, "Error", f"Problem z połączeniem do serwera. Spróbuj później.")
-            else:
-                QMessageBox.critical(self, "Error",
-                                     "There is a connection issue to the server. Please try again later.")
-            self.update_progress_bar(0)
-            return
-
-        except WrongZoneError:
-            if self.language == "pl-PL":
-                QMessageBox.critical(self, "Error", f"Twoje identyfikatory nie pochodzą z jednej strefy.")
-            else:
-                QMessageBox.critical(self, "Error", f"Your identifiers are from different zones.")
+        # Fetching and drawing run on a worker thread so the window keeps repainting and Stop stays responsive
+        self.worker_thread = QThread(self)
+        self.drawer.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.drawer.run)
+        self.drawer.finished.connect(self.worker_thread.quit, Qt.DirectConnection)
+        self.drawer.failed.connect(self.worker_thread.quit, Qt.DirectConnection)
+        self.drawer.finished.connect(self.on_drawer_finished)
+        self.drawer.failed.connect(self.on_drawer_failed)
+        self.worker_thread.finished.connect(self.on_worker_thread_finished)
+        self.ok_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        # Set on the window only, so message boxes shown during the run keep the normal cursor
+        self.setCursor(Qt.BusyCursor)
+        self.worker_thread.start()
+
+    def on_stop_click(self):
+        self.stop_requested = True
+        self.drawer.request_stop()
+
+    def on_worker_thread_finished(self):
+        # A new thread is created for every run, so release this one instead of keeping it as a child of the window
+        self.worker_thread.deleteLater()
+        self.worker_thread = None
+        self.ok_button.setEnabled(self.identifier_reader is None)
+        self.stop_button.setEnabled(False)
+        self.unsetCursor()
+
+    def on_drawer_failed(self, error):
+        message_key = _FAILURE_MESSAGE_KEYS.get(type(error))
+        if message_key:
+            # Only the unknown-zone text has a placeholder, format() ignores the argument for the others
+            message = self.messages[message_key].format(getattr(error, 'identifier', ''))
+        else:
+            message = str(error)
+        QMessageBox.critical(self, "Error", message)
+        self.update_progress_bar(0)
+
+    def on_drawer_finished(self):
+        if self.drawer.error_messages and not self.stop_requested:
+            self.show_error_message(self.drawer.error_messages)
+        if self.stop_requested:
             self.update_progress_bar(0)
             return
 
         try:
-            if not self.stop_requested:
-                self.drawer.save_dxf()
-                self.drawer.save_log_error()
+            self.drawer.save_dxf()
+            self.drawer.save_log_error()
         except PathNotFoundError as e:
             error_message = str(e)
             path_error = error_message.split(": ")[1]
-            if self.language == "pl-PL":
-                QMessageBox.critical(self, "Error", f"Podana ścieżka nie istnieje: {path_error}, spróbuj ponownie")
-            else:
-                QMessageBox.critical(self, "Error", f"The path not found: {path_error}, please try again")
+            QMessageBox.critical(self, "Error", self.messages["save_path_not_found"].format(path_error))
             self.update_progress_bar(0)
             return
 
-        if not self.stop_requested:
-            if self.language == "pl-PL":
-                success_message = "Obramowania działek zostały dodane"
-            else:
-                success_message = "Plot borders have been added"
-            QMessageBox.information(self, "Success", success_message)
+        QMessageBox.information(self, "Success", self.messages["success"])
+
+    def closeEvent(self, event):
+        # Let a running batch wind down instead of destroying its thread mid-run
+        if self.worker_thread is not None and self.worker_thread.isRunning():
+            self.stop_requested = True
+            self.drawer.request_stop()
+            self.worker_thread.wait()
+        super().closeEvent(event)
 
     @staticmethod
     def read_identifiers_from_file(file_path):
-        with open(file_path, 'r') as file:
-            return file.read().split(',')
\ No newline at end of file
+        # Identifiers may be separated by commas, whitespace or new lines, empty entries are dropped
+        with open(file_path, 'r', buffering=1 << 20) as file:
+            return [identifier for identifier in re.split(r'[,\s]+', file.read()) if identifier]
\ No newline at end of file
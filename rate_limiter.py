@@ -0,0 +1,80 @@
+# Copyright © 2024 Michal Chmielewski
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, max_pause=30):
+        self.rate = rate
+        self.burst = burst
+        self.max_pause = max_pause
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        # Returns False instead of a token once stop() was called, waiting callers wake up right away
+        while not self.stopped.is_set():
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            self.stopped.wait(wait)
+        return False
+
+    def stop(self):
+        self.stopped.set()
+
+    def pause(self, delay):
+        # Drain the bucket as well, so after the cool-down requests come back one by one at `rate`
+        # instead of the whole burst hitting the server again. Capped so a huge server hint can't stall a run.
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + min(delay, self.max_pause))
+
+    def update_from_headers(self, headers):
+        # Returns True when the headers asked for a real pause, so the caller knows not to back off on its own
+        retry_after = self._parse_retry_after(headers.get('Retry-After'))
+        if retry_after is not None:
+            self.pause(retry_after)
+            return retry_after > 0
+
+        remaining = self._parse_seconds(headers.get('X-RateLimit-Remaining'))
+        reset = self._parse_seconds(headers.get('X-RateLimit-Reset'))
+        if remaining is not None and remaining < 1 and reset is not None:
+            # Reset is sent either as seconds left or as an epoch timestamp
+            if reset > 10 ** 9:
+                reset -= time.time()
+            self.pause(max(reset, 0))
+            return reset > 0
+        return False
+
+    @classmethod
+    def _parse_retry_after(cls, value):
+        # Retry-After is either a number of seconds or an HTTP-date
+        seconds = cls._parse_seconds(value)
+        if seconds is not None or value is None:
+            return seconds
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse_seconds(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None